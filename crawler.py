@@ -4,14 +4,187 @@ Site Tomograph - 非同步爬蟲引擎
 
 import asyncio
 import aiohttp
-from bs4 import BeautifulSoup
-from urllib.parse import urljoin, urlparse
-from typing import AsyncGenerator, Set, Dict, List, Optional
+import socket
+import ssl
+from aiohttp.abc import ResolveResult
+from aiohttp.resolver import AsyncResolver
+from contextlib import contextmanager, nullcontext
+from selectolax.lexbor import LexborHTMLParser
+from functools import lru_cache
+from urllib.parse import ParseResult, urljoin, urlparse
+from typing import AsyncGenerator, ContextManager, Iterator, Set, Dict, List, Optional, Sequence, Tuple
 from urllib.robotparser import RobotFileParser
+import re
+import sys
 import time
 import random
 
 
+# 節點狀態的整數編碼，數值即報告中的排序優先級
+STATUS_NECROSIS = 0   # 壞死
+STATUS_BLOCKAGE = 1   # 阻塞
+STATUS_HEALTHY = 2    # 健康
+STATUS_PENDING = -1   # 已認領、尚未完成抓取
+STATUS_NAMES = ("necrosis", "blockage", "healthy")
+STATUS_CODES = {name: code for code, name in enumerate(STATUS_NAMES)}
+
+# 非 HTML 資源副檔名：圖片、文件、壓縮檔、影音、樣式、腳本、字型
+_SKIP_EXT = re.compile(
+    r"\.(jpg|jpeg|png|gif|svg|webp|ico|pdf|zip|tar|gz|mp3|mp4|avi|mov|css|js|woff2?|ttf|eot)$",
+    re.IGNORECASE
+)
+
+# 各協定的預設 port，正規化時省略
+_DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def _canonical_netloc(parsed: ParseResult) -> str | None:
+    """主機名轉小寫並省略預設 port；含帳密（userinfo）者回傳 None"""
+    host = parsed.hostname
+    if "@" in parsed.netloc or not host:
+        return None
+    # hostname 會去掉 IPv6 位址的方括號，組回 URL 時需補上
+    if ":" in host:
+        host = f"[{host}]"
+    port = parsed.port
+    if port is None or port == _DEFAULT_PORTS.get(parsed.scheme):
+        return host
+    return f"{host}:{port}"
+
+
+@lru_cache(maxsize=16384)
+def _canonicalize_url(base_domain: str, full_url: str) -> str | None:
+    """
+    將絕對 URL 正規化為爬蟲使用的唯一鍵，非同域名或非 HTML 資源則回傳 None
+
+    純函式並以 lru_cache 快取：頁首、頁尾等共用連結在每頁都會出現，
+    快取鍵為絕對 URL，因此跨頁面也能命中
+    """
+    try:
+        parsed = urlparse(full_url)
+
+        # 只處理 http/https
+        if parsed.scheme not in ("http", "https"):
+            return None
+
+        # 只處理同域名（主機名不分大小寫、預設 port 視為相同）
+        netloc = _canonical_netloc(parsed)
+        if netloc != base_domain:
+            return None
+
+        # 略過圖片、PDF 等非 HTML 資源，避免無用的請求
+        if _SKIP_EXT.search(parsed.path):
+            return None
+
+        # 正規化路徑：移除尾端斜線以統一 (M03 修復)
+        # 修正：原邏輯在 path='/' 時 len=1 導致不會移除斜線
+        # 例如 example.com/ 和 example.com 應該視為相同
+        path = parsed.path.rstrip('/') if parsed.path else ''
+
+        # 移除 fragment 和 query string（簡化）
+        normalized = f"{parsed.scheme}://{netloc}{path}"
+
+        # intern：enqueued、節點索引與佇列共用同一個字串物件，
+        # 節省記憶體且集合查找可先以物件身分比對
+        return sys.intern(normalized)
+    except Exception:
+        return None
+
+
+class PinnedResolver(AsyncResolver):
+    """
+    可固定主機解析結果的 DNS 解析器
+
+    SSRF 檢查已解析並驗證過的 IP 透過 pin() 固定下來，掃描期間
+    連線一律使用這些 IP：省去重複查詢，也避免檢查後 DNS 被改指向
+    內部位址（DNS rebinding）。未固定的主機照常以 aiodns 解析。
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # 主機名 -> (IP 清單, 使用中的掃描數)
+        self._pins: Dict[str, Tuple[Tuple[str, ...], int]] = {}
+
+    @contextmanager
+    def pin(self, host: str, ips: Sequence[str]) -> Iterator[None]:
+        """在 with 區塊內固定 host 的解析結果；同一主機可被多個掃描同時固定"""
+        host = host.lower()
+        _, count = self._pins.get(host, ((), 0))
+        self._pins[host] = (tuple(ips), count + 1)
+        try:
+            yield
+        finally:
+            ips, count = self._pins[host]
+            if count <= 1:
+                del self._pins[host]
+            else:
+                self._pins[host] = (ips, count - 1)
+
+    async def resolve(
+        self, host: str, port: int = 0, family: socket.AddressFamily = socket.AF_INET
+    ) -> List[ResolveResult]:
+        pinned = self._pins.get(host.lower())
+        if pinned is None:
+            return await super().resolve(host, port, family)
+
+        hosts: List[ResolveResult] = []
+        for ip in pinned[0]:
+            ip_family = socket.AF_INET6 if ":" in ip else socket.AF_INET
+            if family not in (socket.AF_UNSPEC, ip_family):
+                continue
+            hosts.append(ResolveResult(
+                hostname=host,
+                host=ip,
+                port=port,
+                family=ip_family,
+                proto=0,
+                flags=socket.AI_NUMERICHOST | socket.AI_NUMERICSERV,
+            ))
+        if not hosts:
+            raise OSError(None, "DNS lookup failed")
+        return hosts
+
+
+@lru_cache(maxsize=64)
+def _pinned_ssl_context(ips: Tuple[str, ...]) -> ssl.SSLContext:
+    """
+    每組固定 IP 專用的 TLS 設定
+
+    aiohttp 以 (主機, port, ssl, ...) 區分 keep-alive 連線池；不同的固定 IP
+    使用不同的 ssl 物件，主機改固定到新 IP 後就不會重用連到舊 IP 的連線
+    （HTTP 請求不使用 TLS，但同樣依此區分連線池）
+    """
+    return ssl.create_default_context()
+
+
+def create_session(
+    limit: int = 100,
+    limit_per_host: int = 0,
+    resolver: Optional[AsyncResolver] = None
+) -> aiohttp.ClientSession:
+    """
+    建立爬蟲用的 ClientSession
+
+    - aiodns（c-ares）非同步解析 DNS；不啟用 connector 的 DNS 快取，
+      每次連線都經過解析器，固定的解析結果才不會被舊快取蓋過
+    - 保持 keep-alive 連線 60 秒，BFS 過程中重用 TCP/TLS 連線
+    - 不保留 cookie，session 可安全地跨掃描共用
+    - 傳入 PinnedResolver 可讓掃描使用 SSRF 檢查時解析的 IP
+    """
+    connector = aiohttp.TCPConnector(
+        resolver=resolver or PinnedResolver(),
+        use_dns_cache=False,
+        limit=limit,
+        limit_per_host=limit_per_host,
+        force_close=False,
+        keepalive_timeout=60,
+    )
+    return aiohttp.ClientSession(
+        connector=connector,
+        cookie_jar=aiohttp.DummyCookieJar(),
+    )
+
+
 class SiteCrawler:
     """
     非同步網站爬蟲，支援即時串流結果
@@ -31,8 +204,13 @@ class SiteCrawler:
         max_concurrent: int = 3,        # 降低並發數
         max_pages: int = 50,            # 總頁面上限
         request_delay: float = 0.5,     # 請求間隔（秒）
+        max_crawl_delay: float = 5.0,   # robots.txt Crawl-delay 上限（秒）
         max_retries: int = 3,           # 重試次數 (H06)
-        respect_robots: bool = True     # 遵守 robots.txt (H04)
+        respect_robots: bool = True,    # 遵守 robots.txt (H04)
+        max_body_bytes: int = 2_000_000,  # 單頁讀取上限（位元組）
+        session: Optional[aiohttp.ClientSession] = None,  # 外部共用的 session
+        resolver: Optional[PinnedResolver] = None,  # 外部 session 所用的解析器
+        pre_resolved_ips: Sequence[str] = ()  # SSRF 檢查時解析並驗證過的 IP
     ):
         self.start_url = start_url
         self.max_depth = max_depth
@@ -40,20 +218,36 @@ class SiteCrawler:
         self.max_concurrent = max_concurrent
         self.max_pages = max_pages
         self.request_delay = request_delay
+        self.max_crawl_delay = max_crawl_delay
         self.max_retries = max_retries
         self.respect_robots = respect_robots
+        self.max_body_bytes = max_body_bytes
 
         # 解析起始 URL 的域名
         parsed = urlparse(start_url)
-        self.base_domain = parsed.netloc
+        self.base_domain = _canonical_netloc(parsed) or parsed.netloc
+        self.base_host = parsed.hostname or ""
         self.base_scheme = parsed.scheme or "https"
 
-        # 追蹤已訪問的 URL
-        self.visited: Set[str] = set()
-
-        # 儲存節點與連結資料
-        self.nodes: Dict[str, dict] = {}
-        self.links: List[dict] = []
+        # 追蹤已加入佇列的 URL（入列時去重，避免重複連結塞滿佇列）
+        self.enqueued: Set[str] = {start_url}
+        # 是否已達頁面上限
+        self._limit_reached = False
+
+        # 各主機下一次允許發出請求的時間（event loop 時鐘）
+        self._next_allowed: Dict[str, float] = {}
+
+        # 節點資料以平行陣列（SoA）儲存，陣列索引即節點編號；
+        # url_to_idx 同時作為已訪問集合
+        self.urls: List[str] = []
+        self.depths: List[int] = []
+        self.status_codes: List[int] = []
+        self.latencies: List[int] = []
+        self.statuses: List[int] = []  # STATUS_* 整數編碼
+        self.in_degrees: List[int] = []  # 隨連結加入即時累計
+        self.url_to_idx: Dict[str, int] = {}
+        # 連結以 (來源索引, 目標索引) 儲存
+        self.links: List[Tuple[int, int]] = []
 
         # 統計資料
         self.stats = {
@@ -69,33 +263,73 @@ class SiteCrawler:
         # robots.txt 解析器 (H04)
         self._robots_parser: Optional[RobotFileParser] = None
         self._robots_loaded = False
+        self._robots_cache: Dict[str, bool] = {}
+
+        # HTTP session：外部傳入者由呼叫端負責關閉
+        self._session = session
+        self._owns_session = False
+
+        # 掃描期間將起始主機固定解析到 pre_resolved_ips
+        self._resolver = resolver
+        self.pre_resolved_ips = tuple(pre_resolved_ips)
+        self._ssl: ssl.SSLContext | bool = (
+            _pinned_ssl_context(self.pre_resolved_ips) if self.pre_resolved_ips else True
+        )
+
+    async def start(self) -> None:
+        """建立爬蟲自有的 session，之後的每次 scan() 都會重用"""
+        if self._session is None:
+            self._resolver = self._resolver or PinnedResolver()
+            self._session = create_session(
+                limit=self.max_concurrent * 2,
+                limit_per_host=self.max_concurrent,
+                resolver=self._resolver,
+            )
+            self._owns_session = True
 
-    def _normalize_url(self, url: str, base_url: str) -> str | None:
-        """正規化 URL，只保留同域名的連結"""
-        try:
-            # 處理相對路徑
-            full_url = urljoin(base_url, url)
-            parsed = urlparse(full_url)
-
-            # 只處理 http/https
-            if parsed.scheme not in ("http", "https"):
-                return None
+    async def close(self) -> None:
+        """關閉爬蟲自有的 session（外部傳入的 session 不受影響）"""
+        if self._owns_session and self._session is not None:
+            await self._session.close()
+            self._session = None
+            self._owns_session = False
 
-            # 只處理同域名
-            if parsed.netloc != self.base_domain:
-                return None
+    async def __aenter__(self) -> "SiteCrawler":
+        await self.start()
+        return self
 
-            # 正規化路徑：移除尾端斜線以統一 (M03 修復)
-            # 修正：原邏輯在 path='/' 時 len=1 導致不會移除斜線
-            # 例如 example.com/ 和 example.com 應該視為相同
-            path = parsed.path.rstrip('/') if parsed.path else ''
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
 
-            # 移除 fragment 和 query string（簡化）
-            normalized = f"{parsed.scheme}://{parsed.netloc}{path}"
+    def _normalize_url(self, url: str, base_url: str, base_origin: str | None = None) -> str | None:
+        """
+        正規化 URL，只保留同域名的連結
 
-            return normalized
+        base_origin 為 base_url 的 "scheme://netloc"，由呼叫端每頁預先計算一次；
+        常見的絕對路徑與根目錄相對路徑直接組合，不必每個連結都重新解析 base_url
+        """
+        try:
+            if url.startswith(("http://", "https://")):
+                # 外部域名提早排除，不進入完整解析；
+                # base_domain 與 URL 原文同形式（IPv6 位址含方括號）才能直接比對前綴
+                host_part = url.partition("://")[2][:len(self.base_domain)]
+                if host_part.lower() != self.base_domain:
+                    return None
+                full_url = url
+            else:
+                if base_origin is None:
+                    parsed_base = urlparse(base_url)
+                    base_origin = f"{parsed_base.scheme}://{parsed_base.netloc}"
+                if url.startswith("//"):
+                    full_url = f"{base_origin.partition(':')[0]}:{url}"
+                elif url.startswith("/") and "/." not in url:
+                    full_url = base_origin + url
+                else:
+                    # 處理相對路徑（含 ./、../ 等需要解析的情況）
+                    full_url = urljoin(base_url, url)
         except Exception:
             return None
+        return _canonicalize_url(self.base_domain, full_url)
 
     async def _load_robots_txt(self, session: aiohttp.ClientSession) -> None:
         """
@@ -111,7 +345,8 @@ class SiteCrawler:
             async with session.get(
                 robots_url,
                 timeout=aiohttp.ClientTimeout(total=5),
-                headers={"User-Agent": self.user_agent}
+                headers={"User-Agent": self.user_agent},
+                ssl=self._ssl,
             ) as response:
                 if response.status == 200:
                     content = await response.text()
@@ -128,7 +363,41 @@ class SiteCrawler:
         if not self.respect_robots or self._robots_parser is None:
             return True
 
-        return self._robots_parser.can_fetch(self.user_agent, url)
+        # User-Agent 與主機固定，結果只取決於路徑；快取大小受 max_pages 限制
+        path = urlparse(url).path
+        allowed = self._robots_cache.get(path)
+        if allowed is None:
+            allowed = self._robots_parser.can_fetch(self.user_agent, url)
+            self._robots_cache[path] = allowed
+        return allowed
+
+    def _request_interval(self) -> float:
+        """
+        同一主機兩次請求的最小間隔：取 request_delay 與 robots.txt Crawl-delay 較大者
+
+        Crawl-delay 由目標網站決定，以 max_crawl_delay 為上限，
+        避免網站設定極大值而長時間佔用掃描槽位
+        """
+        if self.respect_robots and self._robots_parser is not None:
+            crawl_delay = self._robots_parser.crawl_delay(self.user_agent)
+            if crawl_delay:
+                return max(self.request_delay, min(float(crawl_delay), self.max_crawl_delay))
+        return self.request_delay
+
+    async def _wait_for_turn(self, url: str) -> None:
+        """
+        依主機排程請求時間，只等待距離下一個允許時間的差值
+
+        先預約時段再等待，多個 worker 同時呼叫時不需要鎖；
+        網路延遲大於請求間隔時不會額外等待
+        """
+        host = urlparse(url).netloc
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        slot = max(now, self._next_allowed.get(host, 0.0))
+        self._next_allowed[host] = slot + self._request_interval()
+        if slot > now:
+            await asyncio.sleep(slot - now)
 
     async def _fetch_with_retry(
         self,
@@ -176,6 +445,27 @@ class SiteCrawler:
             "error": str(last_error) if last_error else "重試次數已達上限"
         }
 
+    async def _read_body(self, response: aiohttp.ClientResponse) -> str:
+        """
+        分塊讀取回應內容，超過 max_body_bytes 即停止
+
+        避免意外的大型回應佔用記憶體，並限制單頁的解析成本
+        """
+        chunks = []
+        total = 0
+        async for chunk in response.content.iter_chunked(65536):
+            chunks.append(chunk)
+            total += len(chunk)
+            if total >= self.max_body_bytes:
+                break
+
+        body = b"".join(chunks)[:self.max_body_bytes]
+        try:
+            return body.decode(response.charset or "utf-8", errors="replace")
+        except LookupError:
+            # 未知的編碼名稱
+            return body.decode("utf-8", errors="replace")
+
     async def _fetch_page(
         self,
         session: aiohttp.ClientSession,
@@ -190,7 +480,12 @@ class SiteCrawler:
         }
 
         try:
-            async with session.get(url, timeout=aiohttp.ClientTimeout(total=10), headers=headers) as response:
+            async with session.get(
+                url,
+                timeout=aiohttp.ClientTimeout(total=10),
+                headers=headers,
+                ssl=self._ssl,
+            ) as response:
                 latency = int((time.time() - start_time) * 1000)
                 status_code = response.status
 
@@ -203,16 +498,24 @@ class SiteCrawler:
                     status = "healthy"   # 健康
 
                 # 解析 HTML 抽取連結
-                links = []
+                links: Set[str] = set()
                 if status_code == 200:
                     try:
-                        html = await response.text()
-                        soup = BeautifulSoup(html, "html.parser")
-
-                        for a in soup.find_all("a", href=True):
-                            link = self._normalize_url(a["href"], url)
+                        # 使用 selectolax（lexbor 引擎）解析，只需抽取連結不需完整 DOM
+                        html = await self._read_body(response)
+                        tree = LexborHTMLParser(html)
+
+                        # 同一頁的所有連結共用 base，只解析一次
+                        parsed_base = urlparse(url)
+                        base_origin = f"{parsed_base.scheme}://{parsed_base.netloc}"
+
+                        for a in tree.css("a[href]"):
+                            href = a.attributes.get("href")
+                            if not href:
+                                continue
+                            link = self._normalize_url(href, url, base_origin)
                             if link and link != url:
-                                links.append(link)
+                                links.add(link)
                     except Exception:
                         pass
 
@@ -221,7 +524,7 @@ class SiteCrawler:
                     "status_code": status_code,
                     "latency": latency,
                     "status": status,
-                    "links": list(set(links))  # 去重
+                    "links": list(links)  # 抽取時已用 set 去重
                 }
 
         except asyncio.TimeoutError:
@@ -244,135 +547,268 @@ class SiteCrawler:
             }
 
     async def scan(self) -> AsyncGenerator[dict, None]:
+        """開始掃描，以 async generator 逐一串流事件"""
+        async for batch in self.scan_batches():
+            for event in batch:
+                yield event
+
+    async def scan_batches(
+        self,
+        max_batch: int = 16,
+        linger: float = 0.0
+    ) -> AsyncGenerator[List[dict], None]:
         """
-        開始掃描，以 async generator 形式串流結果
+        開始掃描，以 async generator 批次串流事件
+
+        架構：max_concurrent 個 worker 共用工作佇列並行抓取頁面，
+        產生的事件經由事件佇列交回此 generator；每次取出佇列中
+        已就緒的事件合併為一批，減少傳送次數
+
+        批次在以下任一條件成立時送出：
+        - 累積 max_batch 個事件
+        - 自第一個事件起經過 linger 秒（0 表示只合併已就緒的事件）
+        - 掃描結束或發生錯誤
 
         安全機制：
         - 達到 max_pages 上限時自動停止
-        - 每個請求之間有 request_delay 間隔
+        - 同一主機的請求之間至少間隔 request_delay（或 robots.txt 的 Crawl-delay）
         - 遵守 robots.txt 規則 (H04)
         - 失敗請求自動重試 (H06)
         """
-        # 初始化佇列：(url, depth, parent_url)
-        queue: List[tuple] = [(self.start_url, 0, None)]
-        semaphore = asyncio.Semaphore(self.max_concurrent)
-
-        async with aiohttp.ClientSession() as session:
-            # 載入 robots.txt (H04)
-            await self._load_robots_txt(session)
-
-            while queue:
-                # 安全檢查：達到頁面上限時停止
-                if self.stats["total_pages"] >= self.max_pages:
-                    yield {
-                        "type": "limit_reached",
-                        "message": f"已達到掃描上限（{self.max_pages} 頁），停止掃描以避免過度請求"
-                    }
-                    break
-
-                # 取出下一個要處理的 URL
-                current_url, depth, parent_url = queue.pop(0)
-
-                # 跳過已訪問
-                if current_url in self.visited:
-                    continue
+        # 工作佇列：(url, depth, parent_url)
+        work: asyncio.Queue = asyncio.Queue()
+        work.put_nowait((self.start_url, 0, None))
+        # 事件佇列：None 代表所有工作已完成
+        events: asyncio.Queue = asyncio.Queue()
 
-                # 檢查 robots.txt 是否允許 (H04)
-                if not self._can_fetch(current_url):
-                    continue
+        # 未啟動 session 時，僅為本次掃描建立並於結束時關閉
+        temporary_session = self._session is None
+        await self.start()
+        session = self._session
 
-                self.visited.add(current_url)
-
-                # 發現新節點事件
-                node_id = f"node_{len(self.nodes)}"
-                yield {
-                    "type": "node_discovered",
-                    "id": node_id,
-                    "url": current_url,
-                    "depth": depth
-                }
+        try:
+            with self._pin_start_host():
+                # 載入 robots.txt (H04)
+                await self._load_robots_txt(session)
+
+                workers = [
+                    asyncio.create_task(self._worker(session, work, events))
+                    for _ in range(self.max_concurrent)
+                ]
+                monitor = asyncio.create_task(self._signal_when_done(work, events))
+
+                loop = asyncio.get_running_loop()
+                error: Optional[Exception] = None
+
+                try:
+                    finished = False
+                    while not finished:
+                        batch: List[dict] = []
+                        event = await events.get()
+                        deadline = loop.time() + linger
+                        while True:
+                            if event is None:
+                                finished = True
+                                break
+                            if isinstance(event, Exception):
+                                error = event
+                                finished = True
+                                break
+                            batch.append(event)
+                            if len(batch) >= max_batch:
+                                break
+                            if not events.empty():
+                                event = events.get_nowait()
+                                continue
+                            remaining = deadline - loop.time()
+                            if remaining <= 0:
+                                break
+                            try:
+                                event = await asyncio.wait_for(events.get(), remaining)
+                            except asyncio.TimeoutError:
+                                break
+                        # 結束或錯誤前先送出已累積的事件
+                        if batch:
+                            yield batch
+                    if error is not None:
+                        raise error
+                finally:
+                    for task in (*workers, monitor):
+                        task.cancel()
+                    await asyncio.gather(*workers, monitor, return_exceptions=True)
+        finally:
+            if temporary_session:
+                await self.close()
+
+    def _pin_start_host(self) -> ContextManager[None]:
+        """掃描期間固定起始主機的解析結果（沒有預先解析的 IP 時不做事）"""
+        if self._resolver is None or not self.pre_resolved_ips or not self.base_host:
+            return nullcontext()
+        return self._resolver.pin(self.base_host, self.pre_resolved_ips)
+
+    async def _signal_when_done(self, work: asyncio.Queue, events: asyncio.Queue) -> None:
+        """工作佇列清空且所有 worker 閒置時，送出結束信號"""
+        await work.join()
+        events.put_nowait(None)
+
+    async def _worker(
+        self,
+        session: aiohttp.ClientSession,
+        work: asyncio.Queue,
+        events: asyncio.Queue
+    ) -> None:
+        """從工作佇列取出 URL 並處理，直到被取消"""
+        while True:
+            item = await work.get()
+            try:
+                await self._crawl_page(session, item, work, events)
+            except Exception as e:
+                # 交由 scan() 重新拋出
+                events.put_nowait(e)
+            finally:
+                work.task_done()
+
+    def _add_node(self, url: str, depth: int) -> int:
+        """登記新節點並回傳其索引，診斷欄位先以待定值佔位"""
+        idx = len(self.urls)
+        self.urls.append(url)
+        self.depths.append(depth)
+        self.status_codes.append(0)
+        self.latencies.append(0)
+        self.statuses.append(STATUS_PENDING)
+        self.in_degrees.append(0)
+        self.url_to_idx[url] = idx
+        return idx
+
+    def _add_link(self, source: int, target: int) -> None:
+        """登記連結並累計目標節點的 in-degree"""
+        self.links.append((source, target))
+        self.in_degrees[target] += 1
+
+    def _set_diagnosis(self, idx: int, status_code: int, latency: int, status: str) -> None:
+        """寫入節點的抓取結果"""
+        self.status_codes[idx] = status_code
+        self.latencies[idx] = latency
+        self.statuses[idx] = STATUS_CODES[status]
+
+    async def _crawl_page(
+        self,
+        session: aiohttp.ClientSession,
+        item: tuple,
+        work: asyncio.Queue,
+        events: asyncio.Queue
+    ) -> None:
+        """抓取單一頁面並發出對應事件，將子連結加入工作佇列"""
+        current_url, depth, parent_url = item
+
+        if self._limit_reached:
+            return
 
-                # 如果有父節點，建立連結
-                if parent_url and parent_url in self.nodes:
-                    parent_id = self.nodes[parent_url]["id"]
-                    link_data = {
-                        "source": parent_id,
-                        "target": node_id
-                    }
-                    self.links.append(link_data)
-                    yield {
-                        "type": "link_discovered",
-                        **link_data
-                    }
-
-                # 抓取頁面（帶重試機制）(H06)
-                async with semaphore:
-                    result = await self._fetch_with_retry(session, current_url)
-
-                # 儲存節點資料
-                self.nodes[current_url] = {
-                    "id": node_id,
-                    "depth": depth,
-                    **result
-                }
+        # 安全檢查：達到頁面上限時停止
+        # 以「已認領」的頁面數判斷，避免並行抓取時超出上限
+        if len(self.urls) >= self.max_pages:
+            self._limit_reached = True
+            events.put_nowait({
+                "type": "limit_reached",
+                "message": f"已達到掃描上限（{self.max_pages} 頁），停止掃描以避免過度請求"
+            })
+            return
 
-                # 更新統計
-                self.stats["total_pages"] += 1
-                if result["status"] == "necrosis":
-                    self.stats["dead_links"] += 1
-                elif result["status"] == "blockage":
-                    self.stats["slow_pages"] += 1
-
-                # 診斷更新事件
-                yield {
-                    "type": "diagnosis_update",
-                    "id": node_id,
-                    "url": current_url,
-                    "status_code": result["status_code"],
-                    "latency": result["latency"],
-                    "status": result["status"]
-                }
+        # 檢查 robots.txt 是否允許 (H04)
+        if not self._can_fetch(current_url):
+            return
 
-                # 如果未達最大深度，將子連結加入佇列
-                if depth < self.max_depth:
-                    for link in result["links"]:
-                        if link not in self.visited:
-                            queue.append((link, depth + 1, current_url))
+        # 節點編號於認領時決定，不受抓取完成順序影響
+        idx = self._add_node(current_url, depth)
+        node_id = f"node_{idx}"
+
+        # 發現新節點事件
+        events.put_nowait({
+            "type": "node_discovered",
+            "id": node_id,
+            "url": current_url,
+            "depth": depth
+        })
+
+        # 如果有父節點，建立連結
+        parent_idx = self.url_to_idx.get(parent_url) if parent_url else None
+        if parent_idx is not None:
+            self._add_link(parent_idx, idx)
+            events.put_nowait({
+                "type": "link_discovered",
+                "source": f"node_{parent_idx}",
+                "target": node_id
+            })
 
-                # 請求間隔：降低對目標伺服器的負載
-                await asyncio.sleep(self.request_delay)
+        # 請求間隔：降低對目標伺服器的負載
+        await self._wait_for_turn(current_url)
+
+        # 抓取頁面（帶重試機制）(H06)
+        result = await self._fetch_with_retry(session, current_url)
+
+        # 儲存節點資料
+        self._set_diagnosis(idx, result["status_code"], result["latency"], result["status"])
+
+        # 更新統計
+        self.stats["total_pages"] += 1
+        if result["status"] == "necrosis":
+            self.stats["dead_links"] += 1
+        elif result["status"] == "blockage":
+            self.stats["slow_pages"] += 1
+
+        # 診斷更新事件
+        events.put_nowait({
+            "type": "diagnosis_update",
+            "id": node_id,
+            "url": current_url,
+            "status_code": result["status_code"],
+            "latency": result["latency"],
+            "status": result["status"]
+        })
+
+        # 如果未達最大深度，將子連結加入佇列
+        if depth < self.max_depth:
+            for link in result["links"]:
+                if link not in self.enqueued:
+                    self.enqueued.add(link)
+                    work.put_nowait((link, depth + 1, current_url))
 
     def generate_report(self) -> dict:
         """產生診斷報告"""
-        # 計算孤兒節點（in-degree = 0，除了起始節點）
-        in_degree: Dict[str, int] = {node_id: 0 for node_id in [n["id"] for n in self.nodes.values()]}
-        for link in self.links:
-            if link["target"] in in_degree:
-                in_degree[link["target"]] += 1
+        urls = self.urls
+        statuses = self.statuses
+        # in-degree 已在加入連結時累計，不需再走訪 links
+        in_degree = self.in_degrees
 
+        # 單次走訪節點：找出孤兒節點（in-degree = 0，除了起始節點），
+        # 並收集 (狀態編碼, 深度, 索引) 作為排序鍵
         orphans = []
-        for url, node in self.nodes.items():
-            if url != self.start_url and in_degree.get(node["id"], 0) == 0:
+        order = []
+        for idx, url in enumerate(urls):
+            status = statuses[idx]
+            if status == STATUS_PENDING:
+                continue
+            if url != self.start_url and in_degree[idx] == 0:
                 orphans.append(url)
-                self.stats["orphan_pages"] += 1
-
-        # 建立完整頁面清單
-        # 排序優先級：necrosis (0) → blockage (1) → healthy (2)
-        # 同狀態內依 depth 淺到深
-        status_priority = {"necrosis": 0, "blockage": 1, "healthy": 2}
-
-        all_pages = []
-        for url, node in self.nodes.items():
-            all_pages.append({
-                "url": url,
-                "status": node["status"],
-                "status_code": node["status_code"],
-                "latency": node["latency"],
-                "depth": node.get("depth", 0)
-            })
-
-        # 排序：狀態優先級 → 深度
-        all_pages.sort(key=lambda x: (status_priority.get(x["status"], 2), x["depth"]))
+            order.append((status, self.depths[idx], idx))
+
+        # 直接設定而非累加，重複呼叫 generate_report 不會重複計數
+        self.stats["orphan_pages"] = len(orphans)
+
+        # 排序：necrosis (0) → blockage (1) → healthy (2)，同狀態內依 depth 淺到深；
+        # 狀態編碼即優先級，整數 tuple 直接比較，不需 key 函式
+        order.sort()
+
+        all_pages = [
+            {
+                "url": urls[idx],
+                "status": STATUS_NAMES[status],
+                "status_code": self.status_codes[idx],
+                "latency": self.latencies[idx],
+                "depth": depth
+            }
+            for status, depth, idx in order
+        ]
 
         return {
             "summary": self.stats,
@@ -5,9 +5,11 @@ FastAPI 後端入口
 
 import asyncio
 import logging
-from datetime import datetime
+import time
+from contextlib import asynccontextmanager
+from functools import lru_cache
 
-from typing import Callable, Any
+from typing import AsyncIterator, Callable, Any
 
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request
 from fastapi.staticfiles import StaticFiles
@@ -16,15 +18,15 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import Response
 from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.responses import Response as StarletteResponse
-from crawler import SiteCrawler
+from crawler import PinnedResolver, SiteCrawler, create_session
 from security import (
-    validate_url_safety,
+    validate_url_safety_async,
     rate_limiter,
     ScanRequest,
     sanitize_error_message,
     SECURITY_HEADERS,
 )
-import json
+import orjson
 
 # ============================================================
 # 日誌設定 (M07)
@@ -37,11 +39,24 @@ logging.basicConfig(
 )
 logger = logging.getLogger("site-tomograph")
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    """應用程式生命週期：所有掃描共用同一個 HTTP session（連線池、TLS 重用）"""
+    app.state.resolver = PinnedResolver()
+    app.state.session = create_session(resolver=app.state.resolver)
+    try:
+        yield
+    finally:
+        await app.state.session.close()
+
+
 app = FastAPI(
     title="Site Tomograph",
     description="3D 網站結構診斷儀",
     docs_url=None,  # 生產環境關閉 Swagger
     redoc_url=None,
+    lifespan=lifespan,
 )
 
 
@@ -49,6 +64,13 @@ app = FastAPI(
 # 安全標頭中介層 (C03)
 # ============================================================
 
+# 匯入時預先編碼為 ASGI 原始標頭，每個回應直接附加，不需逐一正規化與編碼
+_SECURITY_HEADERS_RAW = [
+    (header.lower().encode("latin-1"), value.encode("latin-1"))
+    for header, value in SECURITY_HEADERS.items()
+]
+
+
 class SecurityHeadersMiddleware(BaseHTTPMiddleware):
     async def dispatch(
         self,
@@ -56,8 +78,7 @@ class SecurityHeadersMiddleware(BaseHTTPMiddleware):
         call_next: Callable[[Request], Any]
     ) -> StarletteResponse:
         response: StarletteResponse = await call_next(request)
-        for header, value in SECURITY_HEADERS.items():
-            response.headers[header] = value
+        response.raw_headers.extend(_SECURITY_HEADERS_RAW)
         return response
 
 
@@ -91,12 +112,94 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
 
 
+# ============================================================
+# WebSocket 輸入限制 (H02)
+# ============================================================
+
+# 客戶端只需送出 {"url": "..."}，超過此長度的訊息不解析直接拒絕
+MAX_MESSAGE_SIZE = 4096
+
+
+# ============================================================
+# WebSocket 錯誤訊息
+# ============================================================
+
+# 固定的錯誤訊息於匯入時預先編碼，發送時不需再序列化
+_ERR_TIMEOUT = orjson.dumps({"type": "error", "message": "連線逾時，請重新開始掃描"})
+_ERR_INVALID_MESSAGE = orjson.dumps({"type": "error", "message": "無效的訊息格式"})
+_ERR_MESSAGE_TOO_LARGE = orjson.dumps({"type": "error", "message": "訊息過長"})
+
+
+@lru_cache(maxsize=128)
+def _error_frame(message: str) -> bytes:
+    """編碼錯誤訊息；速率限制與 SSRF 檢查的訊息種類有限，快取編碼結果"""
+    return orjson.dumps({"type": "error", "message": message})
+
+
+# ============================================================
+# 事件傳送
+# ============================================================
+
+# 爬蟲產生的 frame 先放入待送佇列，由獨立的傳送 task 寫入 WebSocket，
+# 客戶端接收稍慢時爬蟲仍可繼續；佇列有上限，避免記憶體無限成長
+SEND_QUEUE_SIZE = 128        # 待送 frame 上限
+SEND_STALL_TIMEOUT = 30.0    # 佇列持續滿載超過此秒數即中止掃描
+
+
+class SlowClientError(Exception):
+    """客戶端接收過慢，待送佇列長時間滿載"""
+    pass
+
+
+async def _send_frames(websocket: WebSocket, outbox: asyncio.Queue) -> None:
+    """依序送出佇列中的 frame，收到 None 時結束"""
+    while True:
+        frame = await outbox.get()
+        if frame is None:
+            return
+        await websocket.send_bytes(frame)
+
+
+async def _enqueue_frame(
+    outbox: asyncio.Queue,
+    frame: bytes | None,
+    sender: asyncio.Task
+) -> None:
+    """
+    將 frame 放入待送佇列
+
+    傳送 task 已失敗（如客戶端斷線）時拋出其例外；
+    佇列滿載超過 SEND_STALL_TIMEOUT 秒時拋出 SlowClientError
+    """
+    if sender.done():
+        sender.result()
+    if not outbox.full():
+        outbox.put_nowait(frame)
+        return
+
+    put = asyncio.ensure_future(outbox.put(frame))
+    try:
+        done, _ = await asyncio.wait(
+            (put, sender),
+            timeout=SEND_STALL_TIMEOUT,
+            return_when=asyncio.FIRST_COMPLETED
+        )
+    finally:
+        if not put.done():
+            put.cancel()
+    if put in done:
+        return
+    if sender in done:
+        sender.result()
+    raise SlowClientError("客戶端接收過慢，掃描已中止")
+
+
 def get_client_ip(websocket: WebSocket) -> str:
     """取得客戶端 IP"""
     # 優先使用 X-Forwarded-For（若有反向代理）
     forwarded_for = websocket.headers.get("x-forwarded-for")
     if forwarded_for:
-        return forwarded_for.split(",")[0].strip()
+        return forwarded_for.partition(",")[0].strip()
     # 否則使用直接連線 IP
     client = websocket.client
     return client.host if client else "unknown"
@@ -123,7 +226,7 @@ async def websocket_scan(websocket: WebSocket) -> None:
         allowed, rate_error = await rate_limiter.check_rate_limit(client_ip)
         if not allowed:
             logger.warning(f"[RATE_LIMIT] ip={client_ip} blocked")
-            await websocket.send_json({"type": "error", "message": rate_error})
+            await websocket.send_bytes(_error_frame(rate_error))
             return
 
         scan_started = True  # 標記已佔用速率限制槽位
@@ -137,12 +240,21 @@ async def websocket_scan(websocket: WebSocket) -> None:
                 websocket.receive_text(),
                 timeout=30.0
             )
-            message = json.loads(data)
         except asyncio.TimeoutError:
-            await websocket.send_json({"type": "error", "message": "連線逾時，請重新開始掃描"})
+            await websocket.send_bytes(_ERR_TIMEOUT)
+            return
+
+        # 先限制長度再解析，避免超大或深層巢狀的 JSON 消耗 CPU
+        if len(data) > MAX_MESSAGE_SIZE:
+            await websocket.send_bytes(_ERR_MESSAGE_TOO_LARGE)
+            return
+        try:
+            message = orjson.loads(data)
+        except orjson.JSONDecodeError:
+            await websocket.send_bytes(_ERR_INVALID_MESSAGE)
             return
-        except json.JSONDecodeError:
-            await websocket.send_json({"type": "error", "message": "無效的訊息格式"})
+        if not isinstance(message, dict):
+            await websocket.send_bytes(_ERR_INVALID_MESSAGE)
             return
 
         # Pydantic 驗證
@@ -150,49 +262,69 @@ async def websocket_scan(websocket: WebSocket) -> None:
             scan_request = ScanRequest(url=message.get("url", ""))
             start_url = scan_request.url
         except ValueError as e:
-            await websocket.send_json({"type": "error", "message": str(e)})
+            await websocket.send_bytes(orjson.dumps({"type": "error", "message": str(e)}))
             return
 
         # ============================================================
         # SSRF 防護 (C01)
         # ============================================================
-        is_safe, safety_error = validate_url_safety(start_url)
+        is_safe, safety_error, resolved_ips = await validate_url_safety_async(scan_request.parsed)
         if not is_safe:
             logger.warning(f"[SSRF_BLOCK] ip={client_ip} url={start_url}")
-            await websocket.send_json({"type": "error", "message": safety_error})
+            await websocket.send_bytes(_error_frame(safety_error))
             return
 
         # ============================================================
         # 執行掃描
         # ============================================================
         logger.info(f"[SCAN_START] ip={client_ip} url={start_url}")
-        scan_start_time = datetime.now()
+        scan_start_time = time.monotonic()
 
         crawler = SiteCrawler(
             start_url=start_url,
             max_depth=3,
-            latency_threshold=2000  # 2 秒
+            latency_threshold=2000,  # 2 秒
+            session=websocket.app.state.session,
+            # 連線固定使用 SSRF 檢查時驗證過的 IP (C01)
+            resolver=websocket.app.state.resolver,
+            pre_resolved_ips=resolved_ips,
         )
 
-        # 串流掃描結果
-        async for event in crawler.scan():
-            await websocket.send_json(event)
-
-        # 掃描完成
-        report = crawler.generate_report()
-        scan_duration = (datetime.now() - scan_start_time).total_seconds()
-        summary = report.get("summary", {})
-        logger.info(
-            f"[SCAN_COMPLETE] ip={client_ip} url={start_url} "
-            f"pages={summary.get('total_pages', 0)} "
-            f"dead={summary.get('dead_links', 0)} "
-            f"slow={summary.get('slow_pages', 0)} "
-            f"duration={scan_duration:.1f}s"
-        )
-        await websocket.send_json({
-            "type": "scan_complete",
-            "report": report
-        })
+        outbox: asyncio.Queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+        sender = asyncio.create_task(_send_frames(websocket, outbox))
+        try:
+            # 串流掃描結果
+            # 50ms 內產生的事件（最多 16 個）合併為一個 batch frame；
+            # orjson 直接編碼為 UTF-8 bytes，以 binary frame 傳送
+            async for batch in crawler.scan_batches(max_batch=16, linger=0.05):
+                await _enqueue_frame(
+                    outbox, orjson.dumps({"type": "batch", "events": batch}), sender
+                )
+
+            # 掃描完成
+            report = crawler.generate_report()
+            scan_duration = time.monotonic() - scan_start_time
+            summary = report.get("summary", {})
+            logger.info(
+                f"[SCAN_COMPLETE] ip={client_ip} url={start_url} "
+                f"pages={summary.get('total_pages', 0)} "
+                f"dead={summary.get('dead_links', 0)} "
+                f"slow={summary.get('slow_pages', 0)} "
+                f"duration={scan_duration:.1f}s"
+            )
+            await _enqueue_frame(outbox, orjson.dumps({
+                "type": "scan_complete",
+                "report": report
+            }), sender)
+
+            # 等待佇列中的 frame 全部送出
+            await _enqueue_frame(outbox, None, sender)
+            await sender
+        finally:
+            # 中途失敗時停止傳送，之後的錯誤訊息才不會與其並行寫入
+            if not sender.done():
+                sender.cancel()
+                await asyncio.gather(sender, return_exceptions=True)
 
     except WebSocketDisconnect:
         logger.info(f"[DISCONNECT] ip={client_ip} client disconnected")
@@ -204,16 +336,28 @@ async def websocket_scan(websocket: WebSocket) -> None:
         logger.error(f"[SCAN_ERROR] ip={client_ip} error={type(e).__name__}: {e}")
         safe_message = sanitize_error_message(e)
         try:
-            await websocket.send_json({"type": "error", "message": safe_message})
+            await websocket.send_bytes(orjson.dumps({"type": "error", "message": safe_message}))
         except Exception:
             pass  # 無法發送錯誤訊息，忽略
 
     finally:
         # 釋放速率限制槽位
         if scan_started:
-            await rate_limiter.release_scan()
+            rate_limiter.release_scan()
 
 
 if __name__ == "__main__":
+    import sys
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+
+    # uvloop / httptools 由 uvicorn[standard] 提供；uvloop 不支援 Windows
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=8000,
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools",
+        ws="websockets",
+        # 協定層即拒絕超過上限的 frame，不必先完整接收（UTF-8 每字元最多 4 位元組）
+        ws_max_size=MAX_MESSAGE_SIZE * 4,
+    )
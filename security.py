@@ -6,12 +6,16 @@ Site Tomograph - 安全模組
 
 import ipaddress
 import socket
-from urllib.parse import urlparse
-from typing import Tuple
-from collections import defaultdict
+from urllib.parse import ParseResult, urlparse
+from typing import Optional, Tuple, Union
+from collections import OrderedDict
+import math
+import re
 import time
 import asyncio
 
+from pydantic import BaseModel, PrivateAttr, field_validator, model_validator
+
 
 class SecurityError(Exception):
     """安全相關錯誤"""
@@ -40,76 +44,280 @@ DANGEROUS_HOSTS = frozenset([
 ])
 
 
+# 常見敏感服務 port（SSH、Telnet、SMTP、POP3、IMAP、SMB、資料庫等）
+DANGEROUS_PORTS = frozenset([22, 23, 25, 110, 143, 445, 3306, 5432, 6379, 27017])
+
+
+# 非公開網段：涵蓋 ipaddress 的 is_private / is_loopback / is_link_local /
+# is_multicast / is_reserved / is_unspecified 判定範圍，另加上電信級 NAT 位址
+_IPV4_BLOCKED_NETWORKS = (
+    "0.0.0.0/8",
+    "10.0.0.0/8",
+    "100.64.0.0/10",    # 電信級 NAT（RFC 6598），雲端環境常用於內部服務
+    "127.0.0.0/8",
+    "169.254.0.0/16",
+    "172.16.0.0/12",
+    "192.0.0.0/24",
+    "192.0.2.0/24",
+    "192.168.0.0/16",
+    "198.18.0.0/15",
+    "198.51.100.0/24",
+    "203.0.113.0/24",
+    "224.0.0.0/4",
+    "240.0.0.0/4",
+)
+
+_IPV6_BLOCKED_NETWORKS = (
+    "::/8",             # 含 ::、::1 與 IPv4 映射位址
+    "64:ff9b:1::/48",
+    "100::/8",
+    "200::/7",
+    "400::/6",
+    "800::/5",
+    "1000::/4",
+    "2001::/23",
+    "2001:db8::/32",
+    "2002::/16",
+    "4000::/3",
+    "6000::/3",
+    "8000::/3",
+    "a000::/3",
+    "c000::/3",
+    "e000::/4",
+    "f000::/5",
+    "f800::/6",
+    "fc00::/7",
+    "fe00::/9",
+    "fe80::/10",
+    "fec0::/10",        # 已棄用的 site-local
+    "ff00::/8",
+)
+
+
+def _build_prefix_table(cidrs: Tuple[str, ...]) -> Tuple[Tuple[int, frozenset], ...]:
+    """將網段依前綴長度分組為 (右移位數, 網段前綴集合)，查表時每組只需一次位移與集合查詢"""
+    groups: dict[int, set] = {}
+    for cidr in cidrs:
+        net = ipaddress.ip_network(cidr)
+        shift = net.max_prefixlen - net.prefixlen
+        groups.setdefault(shift, set()).add(int(net.network_address) >> shift)
+    return tuple(
+        (shift, frozenset(prefixes))
+        for shift, prefixes in sorted(groups.items(), reverse=True)
+    )
+
+
+_IPV4_BLOCKED_TABLE = _build_prefix_table(_IPV4_BLOCKED_NETWORKS)
+_IPV6_BLOCKED_TABLE = _build_prefix_table(_IPV6_BLOCKED_NETWORKS)
+
+
+def _in_prefix_table(value: int, table: Tuple[Tuple[int, frozenset], ...]) -> bool:
+    """以整數位元運算檢查位址是否落在表中任一網段"""
+    for shift, prefixes in table:
+        if value >> shift in prefixes:
+            return True
+    return False
+
+
+def _is_private_ip_obj(ip: ipaddress.IPv4Address | ipaddress.IPv6Address) -> bool:
+    """檢查已解析的 IP 物件是否為私有或保留位址"""
+    table = _IPV4_BLOCKED_TABLE if ip.version == 4 else _IPV6_BLOCKED_TABLE
+    return _in_prefix_table(int(ip), table)
+
+
 def is_private_ip(ip_str: str) -> bool:
     """檢查是否為私有 IP 地址"""
+    # 快速路徑：以 inet_pton 直接取得位址整數，不建立 ipaddress 物件
+    for family, table in (
+        (socket.AF_INET, _IPV4_BLOCKED_TABLE),
+        (socket.AF_INET6, _IPV6_BLOCKED_TABLE),
+    ):
+        try:
+            packed = socket.inet_pton(family, ip_str)
+        except OSError:
+            continue
+        return _in_prefix_table(int.from_bytes(packed, "big"), table)
+
+    # 帶 scope ID 的 IPv6（如 fe80::1%eth0）等格式交給 ipaddress
     try:
         ip = ipaddress.ip_address(ip_str)
-        return (
-            ip.is_private or
-            ip.is_loopback or
-            ip.is_link_local or
-            ip.is_multicast or
-            ip.is_reserved or
-            ip.is_unspecified
-        )
     except ValueError:
         return False
+    return _is_private_ip_obj(ip)
 
 
-def validate_url_safety(url: str) -> Tuple[bool, str]:
+def _check_url_static(url: Union[str, ParseResult]) -> Tuple[str, Optional[str]]:
     """
-    驗證 URL 安全性，防止 SSRF 攻擊
+    不需 DNS 的檢查：協定、主機名、黑名單、IP 字面值、port
 
     Returns:
-        Tuple[bool, str]: (是否安全, 錯誤訊息)
+        Tuple[str, Optional[str]]: (錯誤訊息, 需要 DNS 解析的主機名)
+        錯誤訊息為空字串代表通過；主機名為 None 代表不需解析
     """
-    try:
-        parsed = urlparse(url)
-    except Exception:
-        return False, "無效的 URL 格式"
+    if isinstance(url, ParseResult):
+        parsed = url
+    else:
+        try:
+            parsed = urlparse(url)
+        except Exception:
+            return "無效的 URL 格式", None
 
     # 只允許 http/https
     if parsed.scheme not in ("http", "https"):
-        return False, "只支援 HTTP/HTTPS 協定"
+        return "只支援 HTTP/HTTPS 協定", None
 
     # 取得主機名
     hostname = parsed.hostname
     if not hostname:
-        return False, "缺少主機名"
+        return "缺少主機名", None
 
     hostname_lower = hostname.lower()
 
     # 檢查危險域名黑名單
     if hostname_lower in DANGEROUS_HOSTS:
-        return False, "不允許掃描此域名"
+        return "不允許掃描此域名", None
 
-    # 檢查是否直接使用 IP
+    # 檢查 port（阻擋常見敏感 port）；不需 DNS，先於解析檢查
+    try:
+        port = parsed.port
+    except ValueError:
+        return "無效的 URL 格式", None
+    if port in DANGEROUS_PORTS:
+        return f"不允許掃描 port {port}", None
+
+    # 檢查是否直接使用 IP（只解析一次，直接檢查 IP 物件）
     try:
         ip = ipaddress.ip_address(hostname)
-        if is_private_ip(hostname):
-            return False, "不允許掃描私有 IP 位址"
     except ValueError:
-        # 不是 IP，是域名，嘗試解析
-        try:
-            # 解析域名取得 IP
-            resolved_ips = socket.getaddrinfo(hostname, None, socket.AF_UNSPEC, socket.SOCK_STREAM)
-            for family, _, _, _, sockaddr in resolved_ips:
-                ip_str = sockaddr[0]
-                if is_private_ip(ip_str):
-                    return False, "域名解析到私有 IP，不允許掃描"
-        except socket.gaierror:
-            return False, "無法解析域名"
-
-    # 檢查 port（阻擋常見敏感 port）
-    port = parsed.port
-    if port:
-        dangerous_ports = {22, 23, 25, 110, 143, 445, 3306, 5432, 6379, 27017}
-        if port in dangerous_ports:
-            return False, f"不允許掃描 port {port}"
+        # 不是 IP，是域名，需要解析
+        return "", hostname
+
+    if _is_private_ip_obj(ip):
+        return "不允許掃描私有 IP 位址", None
+    return "", None
+
+
+def _check_resolved_ips(ips: Tuple[str, ...]) -> str:
+    """檢查域名解析結果，任一為私有 IP 即拒絕"""
+    for ip_str in ips:
+        if is_private_ip(ip_str):
+            return "域名解析到私有 IP，不允許掃描"
+    return ""
+
+
+# ============================================================
+# DNS 解析快取
+# ============================================================
+
+DNS_CACHE_TTL = 15.0          # 秒
+DNS_CACHE_MAX_SIZE = 4096
+
+# hostname -> (IP 清單, 到期時間)，以插入順序做 LRU 淘汰
+_dns_cache: "OrderedDict[str, Tuple[Tuple[str, ...], float]]" = OrderedDict()
+
+
+def _dns_cache_get(hostname: str) -> Optional[Tuple[str, ...]]:
+    """取得未過期的快取結果"""
+    entry = _dns_cache.get(hostname)
+    if entry is None:
+        return None
+    ips, expires_at = entry
+    if expires_at <= time.monotonic():
+        del _dns_cache[hostname]
+        return None
+    _dns_cache.move_to_end(hostname)
+    return ips
+
+
+def _dns_cache_put(hostname: str, ips: Tuple[str, ...]) -> None:
+    """寫入快取，超過容量時淘汰最久未使用的項目"""
+    _dns_cache[hostname] = (ips, time.monotonic() + DNS_CACHE_TTL)
+    _dns_cache.move_to_end(hostname)
+    while len(_dns_cache) > DNS_CACHE_MAX_SIZE:
+        _dns_cache.popitem(last=False)
+
+
+# 只查詢本機有設定的位址族（AI_ADDRCONFIG），且不做服務名稱查詢（AI_NUMERICSERV）
+_GAI_FLAGS = socket.AI_ADDRCONFIG | socket.AI_NUMERICSERV
+
+
+def _ips_from_addrinfo(infos: list) -> Tuple[str, ...]:
+    """從 getaddrinfo 結果取出不重複的 IP"""
+    return tuple(dict.fromkeys(sockaddr[0] for _, _, _, _, sockaddr in infos))
+
+
+def validate_url_safety(url: Union[str, ParseResult]) -> Tuple[bool, str]:
+    """
+    驗證 URL 安全性，防止 SSRF 攻擊（同步版本，DNS 解析會阻塞）
+
+    可直接傳入已解析的 ParseResult（如 ScanRequest.parsed）以省去重複解析
+
+    Returns:
+        Tuple[bool, str]: (是否安全, 錯誤訊息)
+    """
+    error, hostname = _check_url_static(url)
+    if error:
+        return False, error
+
+    if hostname:
+        ips = _dns_cache_get(hostname)
+        if ips is None:
+            try:
+                ips = _ips_from_addrinfo(
+                    socket.getaddrinfo(
+                        hostname, None, socket.AF_UNSPEC, socket.SOCK_STREAM, 0, _GAI_FLAGS
+                    )
+                )
+            except socket.gaierror:
+                return False, "無法解析域名"
+            _dns_cache_put(hostname, ips)
+        error = _check_resolved_ips(ips)
+        if error:
+            return False, error
 
     return True, ""
 
 
+async def validate_url_safety_async(
+    url: Union[str, ParseResult]
+) -> Tuple[bool, str, Tuple[str, ...]]:
+    """
+    驗證 URL 安全性，防止 SSRF 攻擊（非同步版本）
+
+    可直接傳入已解析的 ParseResult（如 ScanRequest.parsed）以省去重複解析
+
+    DNS 解析交由 event loop 的執行緒池處理，不阻塞其他連線；
+    解析結果快取 DNS_CACHE_TTL 秒
+
+    Returns:
+        Tuple[bool, str, Tuple[str, ...]]: (是否安全, 錯誤訊息, 已驗證的解析 IP)
+        主機為 IP 字面值或檢查未通過時，解析 IP 為空；
+        呼叫端可將解析 IP 交給爬蟲固定使用，避免重複查詢與 DNS rebinding
+    """
+    error, hostname = _check_url_static(url)
+    if error:
+        return False, error, ()
+
+    if hostname:
+        ips = _dns_cache_get(hostname)
+        if ips is None:
+            loop = asyncio.get_running_loop()
+            try:
+                ips = _ips_from_addrinfo(await loop.getaddrinfo(
+                    hostname, None, family=socket.AF_UNSPEC, type=socket.SOCK_STREAM,
+                    flags=_GAI_FLAGS,
+                ))
+            except socket.gaierror:
+                return False, "無法解析域名", ()
+            _dns_cache_put(hostname, ips)
+        error = _check_resolved_ips(ips)
+        if error:
+            return False, error, ()
+        return True, "", ips
+
+    return True, "", ()
+
+
 def sanitize_url_for_display(url: str) -> str:
     """清理 URL 以安全顯示（移除敏感資訊）"""
     try:
@@ -129,84 +337,114 @@ def sanitize_url_for_display(url: str) -> str:
 
 class RateLimiter:
     """
-    簡單的記憶體速率限制器
+    簡單的記憶體速率限制器（token bucket）
 
     限制：
-    - 每個 IP 每分鐘最多 N 個請求
-    - 全域最大並發掃描數
+    - 每個 IP 每分鐘最多 N 個請求（桶容量 N，每秒補充 N/60 個 token）
+    - 全域最大並發掃描數（超過時排隊等待，逾時才拒絕）
     """
 
     def __init__(
         self,
         requests_per_minute: int = 5,
         max_concurrent_scans: int = 10,
-        cleanup_interval: int = 60
+        cleanup_interval: int = 60,
+        max_tracked_ips: int = 50_000,
+        scan_wait_timeout: float = 2.0
     ):
         self.requests_per_minute = requests_per_minute
         self.max_concurrent_scans = max_concurrent_scans
         self.cleanup_interval = cleanup_interval
-
-        # IP -> [timestamp, ...]
-        self._request_times: dict[str, list[float]] = defaultdict(list)
-        # 目前進行中的掃描數
-        self._active_scans = 0
-        # 鎖
-        self._lock = asyncio.Lock()
+        self.max_tracked_ips = max_tracked_ips
+        self.scan_wait_timeout = scan_wait_timeout
+
+        # token 補充速率（每秒）
+        self._refill_rate = requests_per_minute / 60
+        # IP -> (剩餘 token, 上次補充時間)，依最近使用排序，超過上限時淘汰最舊的
+        self._buckets: "OrderedDict[str, tuple[float, float]]" = OrderedDict()
+        # 掃描槽位；槽位已滿時最多排隊等待 scan_wait_timeout 秒
+        self._scan_sem = asyncio.BoundedSemaphore(max_concurrent_scans)
         # 上次清理時間
-        self._last_cleanup = time.time()
+        self._last_cleanup = time.monotonic()
+
+    def _refill(self, tokens: float, last_refill: float, now: float) -> float:
+        """依經過時間補充 token，不超過桶容量"""
+        return min(
+            float(self.requests_per_minute),
+            tokens + (now - last_refill) * self._refill_rate
+        )
+
+    def _available_tokens(self, client_ip: str, now: float) -> float:
+        """取得此 IP 目前的 token（新 IP 為滿桶）"""
+        tokens, last_refill = self._buckets.get(
+            client_ip, (float(self.requests_per_minute), now)
+        )
+        return self._refill(tokens, last_refill, now)
+
+    def _rate_limited_message(self, tokens: float) -> str:
+        """產生需等待秒數的提示訊息"""
+        wait = math.ceil((1 - tokens) / self._refill_rate)
+        return f"請求過於頻繁，請等待 {wait} 秒後再試"
 
     async def check_rate_limit(self, client_ip: str) -> Tuple[bool, str]:
         """
-        檢查是否超過速率限制
+        檢查是否超過速率限制，通過時佔用一個掃描槽位
+
+        槽位已滿時會排隊等待，逾時才回報伺服器繁忙
 
         Returns:
             Tuple[bool, str]: (是否允許, 錯誤訊息)
         """
-        async with self._lock:
-            now = time.time()
-
-            # 定期清理過期記錄
-            if now - self._last_cleanup > self.cleanup_interval:
-                self._cleanup_old_records(now)
-                self._last_cleanup = now
-
-            # 檢查全域並發限制
-            if self._active_scans >= self.max_concurrent_scans:
-                return False, "伺服器繁忙，請稍後再試"
-
-            # 取得此 IP 的請求記錄
-            request_times = self._request_times[client_ip]
-
-            # 移除超過一分鐘的記錄
-            cutoff = now - 60
-            request_times[:] = [t for t in request_times if t > cutoff]
+        now = time.monotonic()
 
-            # 檢查速率
-            if len(request_times) >= self.requests_per_minute:
-                return False, f"請求過於頻繁，請等待 {60 - int(now - request_times[0])} 秒後再試"
+        # 定期清理已補滿的桶
+        if now - self._last_cleanup > self.cleanup_interval:
+            self._cleanup_old_records(now)
+            self._last_cleanup = now
 
-            # 記錄此次請求
-            request_times.append(now)
-            self._active_scans += 1
+        # 先檢查速率，超速的請求不進入排隊
+        tokens = self._available_tokens(client_ip, now)
+        if tokens < 1:
+            return False, self._rate_limited_message(tokens)
 
-            return True, ""
-
-    async def release_scan(self):
+        # 等待掃描槽位
+        try:
+            await asyncio.wait_for(self._scan_sem.acquire(), timeout=self.scan_wait_timeout)
+        except asyncio.TimeoutError:
+            return False, "伺服器繁忙，請稍後再試"
+
+        # 排隊期間同 IP 的其他請求可能已用掉 token，取得槽位後重新計算；
+        # 以下到 return 之間沒有 await，asyncio 單執行緒下即為原子操作，不需要鎖
+        now = time.monotonic()
+        tokens = self._available_tokens(client_ip, now)
+        if tokens < 1:
+            self._scan_sem.release()
+            return False, self._rate_limited_message(tokens)
+
+        # 記錄此次請求
+        self._buckets[client_ip] = (tokens - 1, now)
+        self._buckets.move_to_end(client_ip)
+        while len(self._buckets) > self.max_tracked_ips:
+            self._buckets.popitem(last=False)
+
+        return True, ""
+
+    def release_scan(self) -> None:
         """釋放一個掃描槽位"""
-        async with self._lock:
-            if self._active_scans > 0:
-                self._active_scans -= 1
+        try:
+            self._scan_sem.release()
+        except ValueError:
+            # 沒有佔用中的槽位
+            pass
 
     def _cleanup_old_records(self, now: float):
-        """清理過期記錄"""
-        cutoff = now - 60
-        empty_ips = []
-        for ip, times in self._request_times.items():
-            times[:] = [t for t in times if t > cutoff]
-            if not times:
-                empty_ips.append(ip)
-        for ip in empty_ips:
-            del self._request_times[ip]
+        """清理已補滿的桶（與不存在的記錄等價）"""
+        full_ips = [
+            ip for ip, (tokens, last_refill) in self._buckets.items()
+            if self._refill(tokens, last_refill, now) >= self.requests_per_minute
+        ]
+        for ip in full_ips:
+            del self._buckets[ip]
 
 
 # 全域速率限制器實例
@@ -217,13 +455,14 @@ rate_limiter = RateLimiter()
 # 輸入驗證 (H02)
 # ============================================================
 
-from pydantic import BaseModel, HttpUrl, field_validator
-
 
 class ScanRequest(BaseModel):
     """掃描請求驗證模型"""
     url: str
 
+    # 驗證時解析的結果，供後續 SSRF 檢查直接使用，避免重複解析
+    _parsed: ParseResult = PrivateAttr()
+
     @field_validator('url')
     @classmethod
     def validate_url(cls, v: str) -> str:
@@ -239,21 +478,47 @@ class ScanRequest(BaseModel):
         if len(v) > 2048:
             raise ValueError("URL 過長")
 
-        # 基本格式驗證
+        return v
+
+    @model_validator(mode="after")
+    def parse_url(self) -> "ScanRequest":
+        # 基本格式驗證，並保留解析結果
         try:
-            parsed = urlparse(v)
+            parsed = urlparse(self.url)
             if not parsed.hostname:
                 raise ValueError("無效的 URL 格式")
         except Exception:
             raise ValueError("無效的 URL 格式")
 
-        return v
+        self._parsed = parsed
+        return self
+
+    @property
+    def parsed(self) -> ParseResult:
+        """已解析的 URL"""
+        return self._parsed
 
 
 # ============================================================
 # 錯誤處理 (H03)
 # ============================================================
 
+# 常見的敏感模式 -> 替換字串
+_SENSITIVE_REPLACEMENTS = {
+    "/home/": "",
+    "/var/": "",
+    "/etc/": "",
+    "/usr/": "",
+    "192.168.": "[內部IP]",
+    "10.": "[內部IP]",
+    "172.16.": "[內部IP]",
+    "127.0.0.1": "[localhost]",
+}
+
+# 所有模式合併為單一正規表示式，一次掃描完成替換
+_SENSITIVE_RE = re.compile("|".join(map(re.escape, _SENSITIVE_REPLACEMENTS)))
+
+
 def sanitize_error_message(error: Exception) -> str:
     """
     清理錯誤訊息，移除敏感資訊
@@ -264,23 +529,11 @@ def sanitize_error_message(error: Exception) -> str:
     - 堆疊追蹤
     - 系統資訊
     """
-    error_str = str(error)
-
-    # 常見的敏感模式
-    sensitive_patterns = [
-        ("/home/", ""),
-        ("/var/", ""),
-        ("/etc/", ""),
-        ("/usr/", ""),
-        ("192.168.", "[內部IP]"),
-        ("10.", "[內部IP]"),
-        ("172.16.", "[內部IP]"),
-        ("127.0.0.1", "[localhost]"),
-    ]
-
-    for pattern, replacement in sensitive_patterns:
-        if pattern in error_str:
-            error_str = error_str.replace(pattern, replacement)
+    # 先替換再截斷，避免截斷點切開敏感字串而留下片段
+    error_str = _SENSITIVE_RE.sub(
+        lambda m: _SENSITIVE_REPLACEMENTS[m.group(0)],
+        str(error)
+    )
 
     # 如果錯誤訊息太長，截斷
     if len(error_str) > 200:
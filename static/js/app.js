@@ -21,6 +21,7 @@ class SiteTomograph {
 
         // 狀態
         this.ws = null;
+        this.decoder = new TextDecoder();
         this.isScanning = false;
         this.stats = {
             total: 0,
@@ -160,6 +161,8 @@ class SiteTomograph {
         // 建立 WebSocket 連接
         const wsProtocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
         this.ws = new WebSocket(`${wsProtocol}//${window.location.host}/ws/scan`);
+        // 伺服器以 binary frame 傳送 orjson 編碼的 UTF-8 JSON
+        this.ws.binaryType = 'arraybuffer';
 
         this.ws.onopen = () => {
             this.scanStatus.textContent = '掃描中...';
@@ -168,7 +171,10 @@ class SiteTomograph {
         };
 
         this.ws.onmessage = (event) => {
-            const data = JSON.parse(event.data);
+            const text = typeof event.data === 'string'
+                ? event.data
+                : this.decoder.decode(event.data);
+            const data = JSON.parse(text);
             this.handleMessage(data);
         };
 
@@ -187,6 +193,10 @@ class SiteTomograph {
 
     handleMessage(data) {
         switch (data.type) {
+            case 'batch':
+                data.events.forEach((event) => this.handleMessage(event));
+                break;
+
             case 'node_discovered':
                 this.graph.addNode(data);
                 this.stats.total++;
@@ -3,7 +3,11 @@ Site Tomograph - 爬蟲模組測試
 """
 
 import pytest
-from crawler import SiteCrawler
+from urllib.robotparser import RobotFileParser
+from aiohttp import web
+from aiohttp import test_utils
+
+from crawler import PinnedResolver, SiteCrawler, create_session
 
 
 class TestUrlNormalization:
@@ -60,6 +64,55 @@ class TestUrlNormalization:
         # 正規化後是 https://example.com
         assert result == "https://example.com"
 
+    def test_protocol_relative_url_resolved(self):
+        """協定相對路徑應沿用頁面的協定"""
+        result = self.crawler._normalize_url("//example.com/page", "https://example.com/a")
+        assert result == "https://example.com/page"
+
+    def test_dot_segments_resolved(self):
+        """根目錄相對路徑中的 ../ 應被解析"""
+        result = self.crawler._normalize_url("/a/../b", "https://example.com/x")
+        assert result == "https://example.com/b"
+
+    def test_lookalike_domain_rejected(self):
+        """前綴相同的其他域名應被拒絕"""
+        result = self.crawler._normalize_url("https://example.com.evil.com/", "https://example.com")
+        assert result is None
+
+    def test_host_case_insensitive(self):
+        """主機名大小寫應視為相同"""
+        result = self.crawler._normalize_url("https://EXAMPLE.com/page", "https://example.com")
+        assert result == "https://example.com/page"
+
+    def test_default_port_dropped(self):
+        """預設 port 應被省略"""
+        result = self.crawler._normalize_url("https://example.com:443/page", "https://example.com")
+        assert result == "https://example.com/page"
+
+    def test_ipv6_literal_keeps_brackets(self):
+        """IPv6 位址主機組回 URL 時應保留方括號"""
+        crawler = SiteCrawler("http://[2606:4700::1111]:8080/")
+        result = crawler._normalize_url("/page", "http://[2606:4700::1111]:8080/")
+        assert result == "http://[2606:4700::1111]:8080/page"
+        assert crawler.base_domain == "[2606:4700::1111]:8080"
+
+        crawler = SiteCrawler("http://[2606:4700::1111]/")
+        result = crawler._normalize_url("page", "http://[2606:4700::1111]/")
+        assert result == "http://[2606:4700::1111]/page"
+
+    def test_ipv6_absolute_same_host_accepted(self):
+        """IPv6 位址主機的同主機絕對 URL 應被接受，其他主機應被排除"""
+        crawler = SiteCrawler("http://[2606:4700::1111]/")
+        base = "http://[2606:4700::1111]/"
+        assert crawler._normalize_url("http://[2606:4700::1111]/x", base) == "http://[2606:4700::1111]/x"
+        assert crawler._normalize_url("http://[2606:4700::1112]/x", base) is None
+
+    def test_non_html_extension_rejected(self):
+        """圖片、PDF 等非 HTML 資源應被排除"""
+        for href in ("/logo.PNG", "/file.pdf", "/app.js", "/fonts/a.woff2"):
+            assert self.crawler._normalize_url(href, "https://example.com") is None
+        assert self.crawler._normalize_url("/data.json", "https://example.com") is not None
+
     def test_fragment_removed(self):
         """Fragment 應被移除"""
         result = self.crawler._normalize_url("/page#section", "https://example.com")
@@ -103,6 +156,54 @@ class TestCrawlerInit:
         assert crawler.base_scheme == "http"
 
 
+class TestRequestPacing:
+    """測試請求間隔"""
+
+    def test_default_interval(self):
+        crawler = SiteCrawler("https://example.com", request_delay=0.5)
+        assert crawler._request_interval() == 0.5
+
+    def test_robots_crawl_delay_respected(self):
+        """robots.txt 的 Crawl-delay 較長時應採用"""
+        crawler = SiteCrawler("https://example.com", request_delay=0.5)
+        crawler._robots_parser = RobotFileParser()
+        crawler._robots_parser.parse(["User-agent: *", "Crawl-delay: 2"])
+        assert crawler._request_interval() == 2.0
+
+    def test_robots_crawl_delay_capped(self):
+        """過大的 Crawl-delay 應限制在 max_crawl_delay"""
+        crawler = SiteCrawler("https://example.com", request_delay=0.5, max_crawl_delay=5.0)
+        crawler._robots_parser = RobotFileParser()
+        crawler._robots_parser.parse(["User-agent: *", "Crawl-delay: 86400"])
+        assert crawler._request_interval() == 5.0
+
+    async def test_same_host_requests_spaced(self):
+        """同一主機的連續預約應依序間隔 request_delay"""
+        crawler = SiteCrawler("https://example.com", request_delay=0.05)
+        await crawler._wait_for_turn("https://example.com/a")
+        await crawler._wait_for_turn("https://example.com/b")
+        first_free = crawler._next_allowed["example.com"]
+        await crawler._wait_for_turn("https://example.com/c")
+        assert crawler._next_allowed["example.com"] == pytest.approx(first_free + 0.05)
+
+
+class TestRobots:
+    """測試 robots.txt 判斷 (H04)"""
+
+    def setup_method(self):
+        self.crawler = SiteCrawler("https://example.com")
+        self.crawler._robots_parser = RobotFileParser()
+        self.crawler._robots_parser.parse(["User-agent: *", "Disallow: /private"])
+
+    def test_disallowed_path(self):
+        assert self.crawler._can_fetch("https://example.com/private/page") is False
+        assert self.crawler._can_fetch("https://example.com/public") is True
+
+    def test_result_cached_by_path(self):
+        self.crawler._can_fetch("https://example.com/private")
+        assert self.crawler._robots_cache == {"/private": False}
+
+
 class TestReportGeneration:
     """測試報告生成"""
 
@@ -116,6 +217,62 @@ class TestReportGeneration:
         assert report["summary"]["slow_pages"] == 0
         assert "健康" in report["recommendations"][0]
 
+    def test_orphan_count_idempotent(self):
+        """重複產生報告不應重複累加孤兒節點數"""
+        crawler = SiteCrawler("https://example.com")
+        for depth, url in enumerate(["https://example.com", "https://example.com/lost"]):
+            idx = crawler._add_node(url, depth)
+            crawler._set_diagnosis(idx, 200, 10, "healthy")
+
+        first = crawler.generate_report()
+        second = crawler.generate_report()
+
+        assert first["orphan_nodes"] == ["https://example.com/lost"]
+        assert second["summary"]["orphan_pages"] == 1
+
+    def test_linked_node_not_orphan(self):
+        """有連結指向的節點不是孤兒"""
+        crawler = SiteCrawler("https://example.com")
+        root = crawler._add_node("https://example.com", 0)
+        child = crawler._add_node("https://example.com/child", 1)
+        crawler._add_link(root, child)
+        for idx in (root, child):
+            crawler._set_diagnosis(idx, 200, 10, "healthy")
+
+        report = crawler.generate_report()
+
+        assert crawler.in_degrees == [0, 1]
+        assert report["orphan_nodes"] == []
+
+    def test_pages_sorted_by_status_then_depth(self):
+        """頁面清單依狀態優先級排序，同狀態依深度"""
+        crawler = SiteCrawler("https://example.com")
+        rows = [
+            ("https://example.com", 0, 200, "healthy"),
+            ("https://example.com/slow", 1, 200, "blockage"),
+            ("https://example.com/dead-deep", 2, 404, "necrosis"),
+            ("https://example.com/dead", 1, 500, "necrosis"),
+        ]
+        for url, depth, code, status in rows:
+            idx = crawler._add_node(url, depth)
+            crawler._set_diagnosis(idx, code, 10, status)
+
+        pages = crawler.generate_report()["pages"]
+
+        assert [p["url"] for p in pages] == [
+            "https://example.com/dead",
+            "https://example.com/dead-deep",
+            "https://example.com/slow",
+            "https://example.com",
+        ]
+        assert pages[0] == {
+            "url": "https://example.com/dead",
+            "status": "necrosis",
+            "status_code": 500,
+            "latency": 10,
+            "depth": 1,
+        }
+
     def test_recommendations_for_issues(self):
         """測試問題建議"""
         crawler = SiteCrawler("https://example.com")
@@ -128,3 +285,176 @@ class TestReportGeneration:
         recommendations_text = " ".join(report["recommendations"])
         assert "壞死" in recommendations_text or "dead" in recommendations_text.lower()
         assert "延遲" in recommendations_text or "slow" in recommendations_text.lower()
+
+
+def make_site(pages: dict) -> tuple:
+    """建立測試用網站：pages 為 path -> 連結清單，回傳 (app, 每個路徑的請求次數)"""
+    app = web.Application()
+    hits: dict = {}
+
+    async def handler(request: web.Request) -> web.Response:
+        path = request.path
+        hits[path] = hits.get(path, 0) + 1
+        if path not in pages:
+            return web.Response(status=404)
+        body = "".join(
+            # 以 None 插入 1 KB 填充內容
+            "x" * 1024 if href is None else f'<a href="{href}">link</a>'
+            for href in pages[path]
+        )
+        return web.Response(text=f"<html><body>{body}</body></html>", content_type="text/html")
+
+    app.router.add_route("GET", "/{tail:.*}", handler)
+    return app, hits
+
+
+async def run_scan(crawler: SiteCrawler) -> list:
+    """執行掃描並收集所有事件"""
+    return [event async for event in crawler.scan()]
+
+
+class TestScan:
+    """測試掃描流程（使用本機測試伺服器）"""
+
+    async def test_duplicate_links_fetched_once(self):
+        """重複出現的連結（如頁尾導覽）只應抓取一次"""
+        app, hits = make_site({
+            "/": ["/a", "/b", "/a", "/b"],
+            "/a": ["/", "/b"],
+            "/b": ["/a", "/"],
+        })
+        async with test_utils.TestServer(app) as server:
+            crawler = SiteCrawler(str(server.make_url("/a")), request_delay=0)
+            events = await run_scan(crawler)
+
+        discovered = [e["url"] for e in events if e["type"] == "node_discovered"]
+        assert len(discovered) == len(set(discovered))
+        assert hits["/a"] == 1
+        assert hits["/b"] == 1
+
+    async def test_dead_link_reported(self):
+        """404 頁面應標記為壞死"""
+        app, hits = make_site({"/": ["/missing"]})
+        async with test_utils.TestServer(app) as server:
+            crawler = SiteCrawler(str(server.make_url("/")).rstrip("/"), request_delay=0)
+            events = await run_scan(crawler)
+
+        updates = {e["url"]: e for e in events if e["type"] == "diagnosis_update"}
+        missing = next(u for u in updates if u.endswith("/missing"))
+        assert updates[missing]["status"] == "necrosis"
+        assert crawler.stats["dead_links"] == 1
+
+    async def test_started_session_reused_across_scans(self):
+        """start() 後的 session 應在多次掃描間重用，close() 後才釋放"""
+        app, hits = make_site({"/": []})
+        async with test_utils.TestServer(app) as server:
+            async with SiteCrawler(str(server.make_url("/")), request_delay=0) as crawler:
+                session = crawler._session
+                await run_scan(crawler)
+                assert crawler._session is session
+                assert not session.closed
+            assert session.closed
+
+    async def test_page_limit_respected_with_concurrency(self):
+        """並行抓取時仍不得超過 max_pages，並送出 limit_reached 事件"""
+        pages = {"/": [f"/p{i}" for i in range(10)]}
+        pages.update({f"/p{i}": [] for i in range(10)})
+        app, hits = make_site(pages)
+        async with test_utils.TestServer(app) as server:
+            crawler = SiteCrawler(
+                str(server.make_url("/")).rstrip("/"),
+                max_pages=4,
+                max_concurrent=3,
+                request_delay=0,
+            )
+            events = await run_scan(crawler)
+
+        discovered = [e for e in events if e["type"] == "node_discovered"]
+        assert len(discovered) == 4
+        assert len({e["id"] for e in discovered}) == 4
+        assert sum(e["type"] == "limit_reached" for e in events) == 1
+        assert crawler.stats["total_pages"] == 4
+
+    async def test_body_read_is_bounded(self):
+        """超過 max_body_bytes 之後的內容不應被解析"""
+        app, hits = make_site({
+            "/": ["/early", *[None] * 8, "/late"],
+            "/early": [],
+            "/late": [],
+        })
+        async with test_utils.TestServer(app) as server:
+            crawler = SiteCrawler(
+                str(server.make_url("/")).rstrip("/"),
+                max_body_bytes=4096,
+                request_delay=0,
+            )
+            await run_scan(crawler)
+
+        assert "/early" in hits
+        assert "/late" not in hits
+
+    async def test_scan_batches_bounded(self):
+        """批次事件數不超過 max_batch，展開後與逐一串流的事件相同"""
+        pages = {"/": [f"/p{i}" for i in range(6)]}
+        pages.update({f"/p{i}": [] for i in range(6)})
+        app, hits = make_site(pages)
+        async with test_utils.TestServer(app) as server:
+            crawler = SiteCrawler(str(server.make_url("/")).rstrip("/"), request_delay=0)
+            batches = [batch async for batch in crawler.scan_batches(max_batch=2)]
+
+        assert all(1 <= len(batch) <= 2 for batch in batches)
+        events = [event for batch in batches for event in batch]
+        assert sum(e["type"] == "diagnosis_update" for e in events) == 7
+
+    async def test_scan_batches_linger_coalesces(self):
+        """linger 期間產生的事件應合併，且不遺失任何事件"""
+        pages = {"/": [f"/p{i}" for i in range(6)]}
+        pages.update({f"/p{i}": [] for i in range(6)})
+        app, hits = make_site(pages)
+        async with test_utils.TestServer(app) as server:
+            crawler = SiteCrawler(str(server.make_url("/")).rstrip("/"), request_delay=0)
+            batches = [batch async for batch in crawler.scan_batches(linger=0.5)]
+
+        events = [event for batch in batches for event in batch]
+        assert sum(e["type"] == "node_discovered" for e in events) == 7
+        assert len(batches) < len(events)
+
+    async def test_pre_resolved_ips_pinned(self):
+        """起始主機應連線到預先解析的 IP，掃描結束後解除固定"""
+        app, hits = make_site({"/": ["/a"], "/a": []})
+        async with test_utils.TestServer(app, host="127.0.0.1") as server:
+            crawler = SiteCrawler(
+                f"http://pinned.invalid:{server.port}",
+                request_delay=0,
+                pre_resolved_ips=["127.0.0.1"],
+            )
+            await run_scan(crawler)
+
+        assert hits["/a"] == 1
+        assert crawler.stats["dead_links"] == 0
+        assert crawler._resolver._pins == {}
+
+    async def test_repinned_host_uses_new_ips(self):
+        """共用 session 時，同一主機改固定到新 IP 後應連線到新 IP"""
+        app_a, hits_a = make_site({"/": []})
+        app_b, hits_b = make_site({"/": []})
+        resolver = PinnedResolver()
+        session = create_session(resolver=resolver)
+        try:
+            async with test_utils.TestServer(app_a, host="127.0.0.1") as server_a:
+                port = server_a.port
+                async with test_utils.TestServer(app_b, host="127.0.0.2", port=port):
+                    for ip in ("127.0.0.1", "127.0.0.2"):
+                        crawler = SiteCrawler(
+                            f"http://pinned.invalid:{port}",
+                            request_delay=0,
+                            session=session,
+                            resolver=resolver,
+                            pre_resolved_ips=[ip],
+                        )
+                        await run_scan(crawler)
+        finally:
+            await session.close()
+
+        assert hits_a == {"/robots.txt": 1, "/": 1}
+        assert hits_b == {"/robots.txt": 1, "/": 1}
@@ -0,0 +1,85 @@
+"""
+Site Tomograph - WebSocket 事件傳送測試
+"""
+
+import asyncio
+
+import pytest
+from fastapi import WebSocketDisconnect
+
+import main
+from main import SlowClientError, _enqueue_frame, _send_frames
+
+
+class StubWebSocket:
+    """記錄送出 frame 的假 WebSocket，可設定每次傳送的延遲或直接斷線"""
+
+    def __init__(self, delay: float = 0.0, disconnect: bool = False):
+        self.delay = delay
+        self.disconnect = disconnect
+        self.sent: list = []
+
+    async def send_bytes(self, frame: bytes) -> None:
+        if self.disconnect:
+            raise WebSocketDisconnect()
+        await asyncio.sleep(self.delay)
+        self.sent.append(frame)
+
+
+class TestSendFrames:
+    """測試待送佇列與傳送 task"""
+
+    async def test_all_frames_sent_in_order(self):
+        """正常情況下所有 frame 依序送出，收到 None 後傳送 task 結束"""
+        websocket = StubWebSocket(delay=0.001)
+        outbox: asyncio.Queue = asyncio.Queue(maxsize=2)
+        sender = asyncio.create_task(_send_frames(websocket, outbox))
+
+        frames = [str(i).encode() for i in range(10)]
+        for frame in frames:
+            await _enqueue_frame(outbox, frame, sender)
+        await _enqueue_frame(outbox, None, sender)
+        await asyncio.wait_for(sender, 1.0)
+
+        assert websocket.sent == frames
+
+    async def test_slow_client_aborts(self, monkeypatch):
+        """佇列滿載超過 SEND_STALL_TIMEOUT 時拋出 SlowClientError"""
+        monkeypatch.setattr(main, "SEND_STALL_TIMEOUT", 0.05)
+        websocket = StubWebSocket(delay=10)
+        outbox: asyncio.Queue = asyncio.Queue(maxsize=2)
+        sender = asyncio.create_task(_send_frames(websocket, outbox))
+
+        try:
+            with pytest.raises(SlowClientError):
+                for _ in range(10):
+                    await _enqueue_frame(outbox, b"frame", sender)
+        finally:
+            sender.cancel()
+            await asyncio.gather(sender, return_exceptions=True)
+
+        assert websocket.sent == []
+
+    async def test_sender_failure_reraised(self):
+        """傳送 task 失敗（客戶端斷線）時，下一次放入佇列即拋出其例外"""
+        websocket = StubWebSocket(disconnect=True)
+        outbox: asyncio.Queue = asyncio.Queue(maxsize=2)
+        sender = asyncio.create_task(_send_frames(websocket, outbox))
+
+        with pytest.raises(WebSocketDisconnect):
+            for _ in range(10):
+                await _enqueue_frame(outbox, b"frame", sender)
+
+    async def test_sender_failure_while_queue_full(self, monkeypatch):
+        """佇列滿載等待期間傳送 task 失敗，應立即拋出其例外而非等到逾時"""
+        monkeypatch.setattr(main, "SEND_STALL_TIMEOUT", 5.0)
+        outbox: asyncio.Queue = asyncio.Queue(maxsize=1)
+        outbox.put_nowait(b"queued")
+
+        async def fail_later() -> None:
+            await asyncio.sleep(0.01)
+            raise WebSocketDisconnect()
+
+        sender = asyncio.create_task(fail_later())
+        with pytest.raises(WebSocketDisconnect):
+            await asyncio.wait_for(_enqueue_frame(outbox, b"frame", sender), 1.0)
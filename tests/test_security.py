@@ -2,10 +2,16 @@
 Site Tomograph - 安全模組測試
 """
 
+import asyncio
+import ipaddress
+import time
+
 import pytest
+import security
 from security import (
     is_private_ip,
     validate_url_safety,
+    validate_url_safety_async,
     sanitize_url_for_display,
     sanitize_error_message,
     ScanRequest,
@@ -42,6 +48,46 @@ class TestIsPrivateIP:
         assert is_private_ip("not-an-ip") is False
         assert is_private_ip("") is False
 
+    def test_prefix_table_matches_ipaddress(self):
+        """位元運算結果與 ipaddress 屬性判定一致（刻意加嚴的網段除外）"""
+        stricter = [
+            ipaddress.ip_network(cidr)
+            for cidr in ("100.64.0.0/10", "192.0.0.0/24", "2001::/23", "fec0::/10")
+        ]
+        samples = []
+        for cidr in security._IPV4_BLOCKED_NETWORKS + security._IPV6_BLOCKED_NETWORKS:
+            net = ipaddress.ip_network(cidr)
+            first, last = int(net.network_address), int(net.broadcast_address)
+            size = 2 ** net.max_prefixlen
+            address_class = ipaddress.IPv4Address if net.version == 4 else ipaddress.IPv6Address
+            samples += [address_class(v % size) for v in (first - 1, first, last, last + 1)]
+        for ip in samples:
+            # 100.64.0.0/10、192.0.0.9 等在 ipaddress 不算私有，此處一律阻擋
+            if any(ip.version == net.version and ip in net for net in stricter):
+                continue
+            expected = (
+                ip.is_private or ip.is_loopback or ip.is_link_local or
+                ip.is_multicast or ip.is_reserved or ip.is_unspecified
+            )
+            assert is_private_ip(str(ip)) is expected, str(ip)
+
+    def test_special_ipv4_ranges(self):
+        assert is_private_ip("0.0.0.0") is True
+        assert is_private_ip("169.254.169.254") is True
+        assert is_private_ip("224.0.0.1") is True
+        assert is_private_ip("255.255.255.255") is True
+
+    def test_carrier_grade_nat_blocked(self):
+        assert is_private_ip("100.64.0.1") is True
+        assert is_private_ip("100.127.255.255") is True
+        assert is_private_ip("100.128.0.1") is False
+
+    def test_special_ipv6_ranges(self):
+        assert is_private_ip("fd00::1") is True
+        assert is_private_ip("fe80::1%eth0") is True
+        assert is_private_ip("::ffff:127.0.0.1") is True
+        assert is_private_ip("2606:4700:4700::1111") is False
+
 
 class TestValidateUrlSafety:
     """測試 URL 安全驗證"""
@@ -89,6 +135,50 @@ class TestValidateUrlSafety:
         assert is_safe is False
 
 
+class TestValidateUrlSafetyAsync:
+    """測試非同步 URL 安全驗證與 DNS 快取"""
+
+    def teardown_method(self):
+        security._dns_cache.clear()
+
+    async def test_private_ip_literal_blocked(self):
+        is_safe, error, _ = await validate_url_safety_async("http://10.0.0.1")
+        assert is_safe is False
+        assert "私有" in error
+
+    async def test_public_ip_literal_allowed(self):
+        is_safe, error, ips = await validate_url_safety_async("http://8.8.8.8")
+        assert is_safe is True
+        assert error == ""
+        # IP 字面值不需解析
+        assert ips == ()
+
+    async def test_cached_resolution_used(self):
+        """快取中的解析結果應直接使用，不再查詢 DNS"""
+        security._dns_cache_put("cached.example", ("10.1.2.3",))
+        is_safe, error, ips = await validate_url_safety_async("https://cached.example")
+        assert is_safe is False
+        assert "解析到私有 IP" in error
+        assert ips == ()
+
+    async def test_resolved_ips_returned(self):
+        security._dns_cache_put("public.example", ("93.184.216.34", "2606:2800:220:1::"))
+        is_safe, _, ips = await validate_url_safety_async("https://public.example")
+        assert is_safe is True
+        assert ips == ("93.184.216.34", "2606:2800:220:1::")
+
+    def test_expired_entry_ignored(self):
+        security._dns_cache["stale.example"] = (("10.1.2.3",), time.monotonic() - 1)
+        assert security._dns_cache_get("stale.example") is None
+        assert "stale.example" not in security._dns_cache
+
+    def test_cache_size_bounded(self, monkeypatch):
+        monkeypatch.setattr(security, "DNS_CACHE_MAX_SIZE", 2)
+        for host in ("a.example", "b.example", "c.example"):
+            security._dns_cache_put(host, ("8.8.8.8",))
+        assert list(security._dns_cache) == ["b.example", "c.example"]
+
+
 class TestSanitizeUrlForDisplay:
     """測試 URL 清理"""
 
@@ -123,6 +213,11 @@ class TestSanitizeErrorMessage:
         assert "192.168." not in result
         assert "[內部IP]" in result
 
+    def test_masks_multiple_patterns(self):
+        error = Exception("/home/app failed to reach 127.0.0.1 and 172.16.0.5")
+        result = sanitize_error_message(error)
+        assert result == "app failed to reach [localhost] and [內部IP]0.5"
+
     def test_truncates_long_message(self):
         long_message = "x" * 500
         error = Exception(long_message)
@@ -149,6 +244,17 @@ class TestScanRequest:
         with pytest.raises(ValueError):
             ScanRequest(url="")
 
+    def test_parsed_url_kept(self):
+        req = ScanRequest(url="example.com/path")
+        assert req.parsed.hostname == "example.com"
+        assert req.parsed.path == "/path"
+
+    def test_parsed_url_accepted_by_safety_check(self):
+        req = ScanRequest(url="http://192.168.1.1")
+        is_safe, error = validate_url_safety(req.parsed)
+        assert is_safe is False
+        assert "私有" in error
+
     def test_too_long_url_rejected(self):
         long_url = "https://example.com/" + "a" * 3000
         with pytest.raises(ValueError):
@@ -164,7 +270,7 @@ class TestRateLimiter:
         allowed, error = await limiter.check_rate_limit("1.2.3.4")
         assert allowed is True
         assert error == ""
-        await limiter.release_scan()
+        limiter.release_scan()
 
     @pytest.mark.asyncio
     async def test_blocks_after_limit(self):
@@ -189,24 +295,84 @@ class TestRateLimiter:
         assert allowed1 is True
         assert allowed2 is True
 
+    @pytest.mark.asyncio
+    async def test_tokens_refill_over_time(self):
+        limiter = RateLimiter(requests_per_minute=1)
+
+        await limiter.check_rate_limit("1.2.3.4")
+        limiter.release_scan()
+        allowed, error = await limiter.check_rate_limit("1.2.3.4")
+        assert allowed is False
+        assert "60 秒" in error
+
+        # 模擬經過 60 秒：補充一個 token
+        tokens, last_refill = limiter._buckets["1.2.3.4"]
+        limiter._buckets["1.2.3.4"] = (tokens, last_refill - 60)
+        allowed, _ = await limiter.check_rate_limit("1.2.3.4")
+        assert allowed is True
+
+    @pytest.mark.asyncio
+    async def test_cleanup_drops_full_buckets(self):
+        limiter = RateLimiter(requests_per_minute=1)
+        await limiter.check_rate_limit("1.2.3.4")
+
+        limiter._cleanup_old_records(time.monotonic() + 60)
+        assert "1.2.3.4" not in limiter._buckets
+
+    @pytest.mark.asyncio
+    async def test_tracked_ips_bounded(self):
+        limiter = RateLimiter(max_tracked_ips=2)
+
+        await limiter.check_rate_limit("1.1.1.1")
+        await limiter.check_rate_limit("2.2.2.2")
+        await limiter.check_rate_limit("1.1.1.1")
+        await limiter.check_rate_limit("3.3.3.3")
+
+        # 淘汰最久未使用的 IP
+        assert list(limiter._buckets) == ["1.1.1.1", "3.3.3.3"]
+
     @pytest.mark.asyncio
     async def test_concurrent_scan_limit(self):
-        limiter = RateLimiter(max_concurrent_scans=2)
+        limiter = RateLimiter(max_concurrent_scans=2, scan_wait_timeout=0.01)
 
         await limiter.check_rate_limit("1.1.1.1")
         await limiter.check_rate_limit("2.2.2.2")
 
-        # 第 3 個應該被阻擋
+        # 第 3 個等待逾時後應該被阻擋
         allowed, error = await limiter.check_rate_limit("3.3.3.3")
         assert allowed is False
         assert "繁忙" in error
 
+    @pytest.mark.asyncio
+    async def test_waits_for_free_slot(self):
+        """槽位已滿時排隊，釋放後取得槽位"""
+        limiter = RateLimiter(max_concurrent_scans=1, scan_wait_timeout=1.0)
+        await limiter.check_rate_limit("1.1.1.1")
+
+        waiter = asyncio.create_task(limiter.check_rate_limit("2.2.2.2"))
+        await asyncio.sleep(0)
+        assert not waiter.done()
+
+        limiter.release_scan()
+        allowed, _ = await waiter
+        assert allowed is True
+
+    @pytest.mark.asyncio
+    async def test_rate_limited_request_does_not_wait(self):
+        """超速的請求直接拒絕，不佔用排隊"""
+        limiter = RateLimiter(requests_per_minute=1, max_concurrent_scans=1)
+        await limiter.check_rate_limit("1.2.3.4")
+
+        allowed, error = await asyncio.wait_for(limiter.check_rate_limit("1.2.3.4"), 0.5)
+        assert allowed is False
+        assert "頻繁" in error
+
     @pytest.mark.asyncio
     async def test_release_scan(self):
         limiter = RateLimiter(max_concurrent_scans=1)
 
         await limiter.check_rate_limit("1.1.1.1")
-        await limiter.release_scan()
+        limiter.release_scan()
 
         # 釋放後應該可以再次請求
         allowed, _ = await limiter.check_rate_limit("2.2.2.2")